@@ -1,5 +1,10 @@
 import argparse
+import io
+import mmap
+import os
 import sys
+import numpy as np
+import openpyxl
 import pandas as pd
 import psycopg2
 from decimal import Decimal, ROUND_HALF_UP
@@ -12,182 +17,255 @@ DB_CONFIG = {
     "port":     ""
 }
 
-def add_to_initial_balance(amount: float) -> Decimal:
-    with psycopg2.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                UPDATE initial_balance
-                   SET balance = balance + %s
-                 WHERE id = 1
-                RETURNING balance
-                """,
-                (amount,)
-            )
-            new_balance = Decimal(cur.fetchone()[0]).quantize(Decimal("0.00"), ROUND_HALF_UP)
-        conn.commit()
+_Q = Decimal("0.00")
+
+def add_to_initial_balance(conn, amount: float) -> Decimal:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE initial_balance
+               SET balance = balance + %s
+             WHERE id = 1
+            RETURNING balance
+            """,
+            (Decimal(str(amount)).quantize(_Q, ROUND_HALF_UP),)
+        )
+        new_balance = Decimal(cur.fetchone()[0]).quantize(_Q, ROUND_HALF_UP)
+    conn.commit()
     return new_balance
 
-def get_current_balance() -> Decimal:
-    with psycopg2.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT balance FROM initial_balance WHERE id = 1")
-            balance = Decimal(cur.fetchone()[0]).quantize(Decimal("0.00"), ROUND_HALF_UP)
+def get_current_balance(conn) -> Decimal:
+    with conn.cursor() as cur:
+        cur.execute("SELECT balance FROM initial_balance WHERE id = 1")
+        balance = Decimal(cur.fetchone()[0]).quantize(_Q, ROUND_HALF_UP)
+    conn.commit()
     return balance
 
-def determine_tier(item_type: str, cost: Decimal) -> str:
-    if item_type == 'meal':
-        if cost <= 6:
-            return 'saving'
-        elif cost < 15:
-            return 'balance'
-        else:
-            return 'luxury'
-    elif item_type == 'beverage':
-        if cost <= 2:
-            return 'saving'
-        elif cost < 7:
-            return 'balance'
-        else:
-            return 'luxury'
-    else:
-        raise ValueError(f"Unknown item type: {item_type}")
+def determine_tier(df: pd.DataFrame) -> np.ndarray:
+    cost = df['Cost'].to_numpy()
+    category = df['Category'].to_numpy()
+    meal = category == 'meal'
+    beverage = category == 'beverage'
+    if (unknown := ~(meal | beverage)).any():
+        raise ValueError(f"Unknown item type: {category[unknown][0]}")
+    return np.select(
+        [meal & (cost <= 6), meal & (cost < 15), meal,
+         beverage & (cost <= 2), beverage & (cost < 7), beverage],
+        ['saving', 'balance', 'luxury', 'saving', 'balance', 'luxury'],
+        default=None
+    )
 
-def create_tables():
+def create_tables(conn):
     ddl = """
     CREATE TABLE IF NOT EXISTS initial_balance (
       id      INT PRIMARY KEY DEFAULT 1,
       balance DECIMAL(10,2) NOT NULL
     );
     INSERT INTO initial_balance(id,balance)
-      VALUES (1,n) 
+      VALUES (1, 0.00)
     ON CONFLICT(id) DO NOTHING;
 
     CREATE TABLE IF NOT EXISTS expenses (
       id                SERIAL PRIMARY KEY,
       date              DATE        NOT NULL,
       item              TEXT        NOT NULL,
-      category              TEXT CHECK(type IN ('meal','beverage')),
+      category          TEXT CHECK(category IN ('meal','beverage')),
       quantity          INT         NOT NULL,
       tier              TEXT        NOT NULL,
       cost              DECIMAL(10,2) NOT NULL,
+      amount_spent      DECIMAL(10,2),
       remaining_balance DECIMAL(10,2),
       processed         BOOLEAN     DEFAULT TRUE
     );
+    CREATE UNIQUE INDEX IF NOT EXISTS expenses_key
+      ON expenses(date, item, category, quantity, cost);
+
+    CREATE MATERIALIZED VIEW IF NOT EXISTS expenses_monthly AS
+      SELECT date_trunc('month', date)::date AS month,
+             category,
+             tier,
+             SUM(amount_spent)               AS spent
+        FROM expenses
+    GROUP BY 1, 2, 3;
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_expenses_monthly
+      ON expenses_monthly(month, category, tier);
+
+    CREATE TABLE IF NOT EXISTS sync_meta (
+      path          TEXT PRIMARY KEY,
+      last_mtime_ns BIGINT NOT NULL
+    );
     """
-    with psycopg2.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute(ddl)
-        conn.commit()
+    with conn.cursor() as cur:
+        cur.execute(ddl)
+    conn.commit()
+
+class MappedFile(mmap.mmap):
+    def seekable(self) -> bool:
+        return True
 
 def read_excel(path: str) -> pd.DataFrame:
-    df = pd.read_excel(
-        path,
-        dtype={
-            'Date': str,
-            'Item': str,
-            'Category': str,
-            'Quantity': int,
-            'Cost': float
-        }
-    )
-    df['Date'] = pd.to_datetime(df['Date'], dayfirst=True, errors='raise')
+    mtime_ns = os.stat(path).st_mtime_ns
+    cache = f"{path}.parquet"
+    if os.path.exists(cache):
+        try:
+            cached = pd.read_parquet(cache)
+        except (ImportError, OSError, ValueError):
+            cached = None
+        if cached is not None and cached.attrs.get('source_mtime_ns') == mtime_ns:
+            return cached
+
+    with open(path, 'rb') as f, MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        wb = openpyxl.load_workbook(mm, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, ())
+            width = len(header)
+            rows = (r[:width] + (None,) * (width - len(r)) for r in rows)
+            df = pd.DataFrame(
+                [r for r in rows if any(v is not None for v in r)],
+                columns=header
+            )
+        finally:
+            wb.close()
     required = {'Date', 'Item', 'Category', 'Quantity', 'Cost'}
     if missing := required - set(df.columns):
         raise ValueError(f"Missing columns: {missing}")
+    df = df[['Date', 'Item', 'Category', 'Quantity', 'Cost']].astype(
+        {'Quantity': int, 'Cost': float})
+    df['Date'] = pd.to_datetime(df['Date'], dayfirst=True, errors='raise').dt.normalize()
+    for col in ('Item', 'Category'):
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
     df['Item'] = df['Item'].str.title().str.strip()
     df['Category'] = df['Category'].str.lower().str.strip()
-    df['Cost'] = df['Cost'].apply(
-        lambda v: Decimal(str(v)).quantize(Decimal("0.00"), ROUND_HALF_UP))
+    cents = np.round(df['Cost'].to_numpy() * 100, 6)
+    df['Cost'] = np.sign(cents) * np.floor(np.abs(cents) + 0.5) / 100
+    df['Tier'] = determine_tier(df)
+    df.attrs['source_mtime_ns'] = mtime_ns
     return df
 
-def sync_expenses(df: pd.DataFrame):
-    running_balance = get_current_balance()
-    df_keys = {
-        (r.Date.date(), r.Item, r.Category, r.Quantity, r.Cost)
-        for r in df.itertuples()
-    }
+def sync_expenses(conn, path: str) -> Decimal:
+    source = os.path.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    with conn.cursor() as cur:
+        cur.execute("SELECT last_mtime_ns FROM sync_meta WHERE path = %s", (source,))
+        last = cur.fetchone()
+    conn.commit()
+    if last and last[0] == mtime_ns:
+        running_balance = get_current_balance(conn)
+        print("🔄 No changes since last sync")
+        print(f"Remaining balance : ${running_balance:.2f}")
+        return running_balance
 
-    with psycopg2.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
+    df = read_excel(path)
+    staged = (
+        df.reset_index()
+          .groupby(['Date', 'Item', 'Category', 'Cost'], sort=False, dropna=False, as_index=False)
+          .agg(seq=('index', 'first'), Quantity=('Quantity', 'sum'), Tier=('Tier', 'first'))
+    )
+    if merged := len(df) - len(staged):
+        print(f"➕ Merged {merged} repeated row(s) into their quantities")
+    buf = io.StringIO()
+    staged.to_csv(
+        buf, columns=['seq', 'Date', 'Item', 'Category', 'Quantity', 'Cost', 'Tier'],
+        index=False, header=False, na_rep='\\N',
+        date_format='%Y-%m-%d', float_format='%.2f')
+    buf.seek(0)
+
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL synchronous_commit = OFF")
+        try:
             cur.execute(
                 """
-                SELECT id, date, item, category, quantity, cost
-                  FROM expenses
-                ORDER BY date, id
+                CREATE TEMP TABLE stg (
+                  seq      INT,
+                  date     DATE,
+                  item     TEXT,
+                  category TEXT,
+                  quantity INT,
+                  cost     DECIMAL(10,2),
+                  tier     TEXT
+                ) ON COMMIT DROP
                 """
             )
-            existing = cur.fetchall()
-
-            to_delete = [row[0] for row in existing
-                         if (row[1], row[2], row[3], row[4], row[5]) not in df_keys]
-            if to_delete:
-                cur.execute(
-                    "DELETE FROM expenses WHERE id = ANY(%s)",
-                    (to_delete,)
-                )
-                print(f"🗑 Deleted {len(to_delete)} transaction(s)")
-
-            existing_keys = {
-                (r[1], r[2], r[3], r[4], r[5])
-                for r in existing if r[0] not in to_delete
-            }
-
-            inserts = []
-            for row in df.sort_values('Date').itertuples():
-                
-                key = (row.Date.date(), row.Item, row.Category, row.Quantity, row.Cost)
-                amount_spent = row.Cost * row.Quantity
-                remaining = running_balance.quantize(Decimal("0.00"), ROUND_HALF_UP)
-
-                if key in existing_keys:
-                    cur.execute("""
-                        UPDATE expenses
-                           SET amount_spent = %s,
-                           remaining_balance = %s
-                         WHERE date = %s
-                           AND item = %s
-                           AND category = %s
-                           AND quantity = %s
-                           AND cost = %s
-                    """, (
-                        amount_spent,
-                        remaining,
-                        row.Date.date(),
-                        row.Item,
-                        row.Category,
-                        row.Quantity,
-                        row.Cost
-                    ))
-                else:
-                    running_balance -= row.Cost * row.Quantity
-                    remaining = running_balance.quantize(Decimal("0.00"), ROUND_HALF_UP)
-                    inserts.append(
-                        (row.Date.date(), row.Item, row.Category,
-                         row.Quantity, determine_tier(row.Category, float(row.Cost)),
-                         row.Cost, amount_spent, remaining)
-                    )
-
-            if inserts:
-                cur.executemany(
-                    """
+            cur.copy_expert("COPY stg FROM STDIN WITH (FORMAT CSV, NULL '\\N')", buf)
+
+            cur.execute(
+                """
+                DELETE FROM expenses e
+                 WHERE NOT EXISTS (
+                       SELECT 1
+                         FROM stg s
+                        WHERE (s.date, s.item, s.category, s.quantity, s.cost)
+                            = (e.date, e.item, e.category, e.quantity, e.cost))
+                """
+            )
+            if cur.rowcount:
+                print(f"🗑 Deleted {cur.rowcount} transaction(s)")
+
+            cur.execute(
+                """
+                WITH staged AS (
+                    SELECT s.seq, s.date, s.item, s.category, s.quantity, s.tier, s.cost,
+                           s.cost * s.quantity AS amount_spent,
+                           e.id IS NULL        AS is_new
+                      FROM stg s
+                      LEFT JOIN expenses e
+                        ON (e.date, e.item, e.category, e.quantity, e.cost)
+                         = (s.date, s.item, s.category, s.quantity, s.cost)
+                ), upserted AS (
                     INSERT INTO expenses
                       (date, item, category, quantity, tier, cost, amount_spent, remaining_balance)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    inserts
+                    SELECT st.date, st.item, st.category, st.quantity, st.tier, st.cost,
+                           st.amount_spent,
+                           b.balance - SUM(CASE WHEN st.is_new THEN st.amount_spent ELSE 0 END)
+                                       OVER (ORDER BY st.date, st.seq ROWS UNBOUNDED PRECEDING)
+                      FROM staged st
+                     CROSS JOIN initial_balance b
+                     WHERE b.id = 1
+                     ORDER BY st.date, st.seq
+                    ON CONFLICT (date, item, category, quantity, cost) DO UPDATE
+                       SET amount_spent = EXCLUDED.amount_spent,
+                           remaining_balance = EXCLUDED.remaining_balance
                 )
-                print(f"✅ Inserted {len(inserts)} new expense(s)")
+                UPDATE initial_balance
+                   SET balance = balance - (SELECT COALESCE(SUM(amount_spent), 0)
+                                              FROM staged
+                                             WHERE is_new)
+                 WHERE id = 1
+                RETURNING balance, (SELECT COUNT(*) FROM staged WHERE is_new)
+                """
+            )
+            running_balance, inserted = cur.fetchone()
+            if inserted:
+                print(f"✅ Inserted {inserted} new expense(s)")
             else:
                 print("🔄 No new expenses")
 
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY expenses_monthly")
             cur.execute(
-                "UPDATE initial_balance SET balance = %s WHERE id = 1",
-                (running_balance.quantize(Decimal("0.00"), ROUND_HALF_UP),)
+                """
+                INSERT INTO sync_meta(path, last_mtime_ns)
+                  VALUES (%s, %s)
+                ON CONFLICT(path) DO UPDATE SET last_mtime_ns = EXCLUDED.last_mtime_ns
+                """,
+                (source, mtime_ns)
             )
             conn.commit()
+        except Exception:
+            conn.rollback()
+            try:
+                df.to_parquet(f"{path}.parquet", compression='zstd')
+            except (ImportError, OSError, ValueError):
+                pass
+            raise
+
+        try:
+            os.remove(f"{path}.parquet")
+        except OSError:
+            pass
 
-            print(f"Remaining balance : ${running_balance:.2f}")
+        print(f"Remaining balance : ${running_balance:.2f}")
+    return running_balance
 
 def main():
     parser = argparse.ArgumentParser(description="CashCuddle")
@@ -202,43 +280,43 @@ def main():
     args, _ = parser.parse_known_args()
 
     interactive = not sys.argv[1:] or 'idlelib' in sys.modules
-    create_tables()
+    with psycopg2.connect(**DB_CONFIG) as conn:
+        create_tables(conn)
 
-    net_adj = 0.0
-    current_balance = get_current_balance()
+        net_adj = 0.0
+        current_balance = get_current_balance(conn)
     
-    if interactive:
-        dep = input("Enter deposit amount (or press Enter to skip): ").strip()
-        if dep and float(dep) != 0:
-            net_adj = float(dep)
-            current_balance = add_to_initial_balance(net_adj)
-            print(f"💰 Deposited ${net_adj:.2f}")
-        elif not dep:
-            wd = input("Enter withdraw amount (or press Enter to skip): ").strip()
-            if wd and float(wd) != 0:
-                net_adj = -float(wd)
-                current_balance = add_to_initial_balance(net_adj)
-                print(f"💸 Withdrawn ${abs(net_adj):.2f}")
-    else:
-        if args.deposit not in (None, 0.0):
-            net_adj = args.deposit
-            current_balance = add_to_initial_balance(net_adj)
-            if net_adj > 0:
+        if interactive:
+            dep = input("Enter deposit amount (or press Enter to skip): ").strip()
+            if dep and float(dep) != 0:
+                net_adj = float(dep)
+                current_balance = add_to_initial_balance(conn, net_adj)
                 print(f"💰 Deposited ${net_adj:.2f}")
-            else:
-                print(f"💸 Withdrawn ${abs(net_adj):.2f}")
-
-    print(f"Balance : ${current_balance:.2f}")
-
-    path = "CashCuddle.xlsx" if interactive else args.file
-    try:
-        df = read_excel(path)
-        sync_expenses(df)
-    except FileNotFoundError:
-        if net_adj == 0:
-            print(f"⚠️  File not found: {path}")
-    except Exception as e:
-        print(f"❌ Error: {e}")
+            elif not dep:
+                wd = input("Enter withdraw amount (or press Enter to skip): ").strip()
+                if wd and float(wd) != 0:
+                    net_adj = -float(wd)
+                    current_balance = add_to_initial_balance(conn, net_adj)
+                    print(f"💸 Withdrawn ${abs(net_adj):.2f}")
+        else:
+            if args.deposit not in (None, 0.0):
+                net_adj = args.deposit
+                current_balance = add_to_initial_balance(conn, net_adj)
+                if net_adj > 0:
+                    print(f"💰 Deposited ${net_adj:.2f}")
+                else:
+                    print(f"💸 Withdrawn ${abs(net_adj):.2f}")
+
+        print(f"Balance : ${current_balance:.2f}")
+
+        path = "CashCuddle.xlsx" if interactive else args.file
+        try:
+            sync_expenses(conn, path)
+        except FileNotFoundError:
+            if net_adj == 0:
+                print(f"⚠️  File not found: {path}")
+        except Exception as e:
+            print(f"❌ Error: {e}")
 
 if __name__ == "__main__":
     main()